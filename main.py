@@ -1,9 +1,11 @@
 import os
+import functools
+import json
 import uuid
 import logging
-import schedule
-import datetime
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 from submit_to_google_form import ping, speed
 
@@ -17,6 +19,14 @@ logger = logging.getLogger(__name__)
 SITE_ID = os.getenv("SITE_ID", "A_lost_palantir")
 DEVICE_ID = os.getenv("DEVICE_ID", "A_lost_palantir")
 DEVICE_ID_FILE = "network-monitor/device_id"
+IP_INFO_FILE = "network-monitor/ip_info.json"
+# Public IP lookups are reused for a day so restarts don't depend on ipinfo.io
+IP_INFO_TTL_SECONDS = 24 * 60 * 60
+IP_INFO_TIMEOUT = 3
+PING_INTERVAL_SECONDS = 5 * 60
+SPEED_INTERVAL_SECONDS = 60 * 60
+# (connect, read) seconds, so a hung Prometheus can't stall the scheduler
+PROMETHEUS_TIMEOUT = (2, 5)
 
 # Ping metrics to collect every 5 minutes
 PING_METRICS = {
@@ -46,29 +56,107 @@ SPEED_METRICS = {
     "uptime": 'time() - node_boot_time_seconds{job="node"}',
 }
 
+# 'up' metrics reported as integers (0 or 1)
+UP_METRICS = frozenset(
+    {"google_up", "apple_up", "github_up", "pihole_up", "node_up", "speedtest_up"}
+)
+
+# Speedtest metrics reported in bits per second and converted to Mbps
+BITS_PER_SECOND_METRICS = frozenset({"download_mbps", "upload_mbps"})
+
+
+def _to_up(value):
+    return int(float(value))
+
+
+def _bits_to_mbps(value):
+    return float(value) / 1_000_000
+
+
+# How each Prometheus sample value is converted; anything not listed is a float
+METRIC_CONVERTERS = {
+    **dict.fromkeys(UP_METRICS, _to_up),
+    **dict.fromkeys(BITS_PER_SECOND_METRICS, _bits_to_mbps),
+}
+
+# Label used to tag each series with the metric name it was queried for
+METRIC_LABEL = "custom_metric"
+
+
+def _combine_queries(metrics):
+    """Build one PromQL expression that returns every query in metrics.
+
+    Each query's series are tagged with METRIC_LABEL so they can be told
+    apart in the response, and so `or` never drops series whose other labels
+    happen to match.
+    """
+    return " or ".join(
+        f'label_replace({query}, "{METRIC_LABEL}", "{metric_name}", "", "")'
+        for metric_name, query in metrics.items()
+    )
+
+
+# One Prometheus round trip per collection instead of one per metric
+PING_QUERY = _combine_queries(PING_METRICS)
+SPEED_QUERY = _combine_queries(SPEED_METRICS)
+
 
 class NetworkMonitor:
     def __init__(self):
         self.device_id = DEVICE_ID or SITE_ID or "TEMP_TEST_DATA"
         self.ip_address = None
+        prometheus_url = os.getenv("PROMETHEUS_URL", "http://prometheus:9090")
+        self._prometheus_query_url = f"{prometheus_url}/api/v1/query"
+        # Keep-alive connection to Prometheus, reused by every query
+        self._session = requests.Session()
+        self._session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        )
         self._get_ip_and_location()
 
     def _get_ip_and_location(self):
-        """public IP address and location."""
+        """public IP address and location, cached on disk between restarts."""
+        cached = self._read_ip_info_cache()
+        if cached and time.time() < cached.get("expires", 0):
+            self.ip_address = cached.get("ip")
+            return
         try:
-            response = requests.get("https://ipinfo.io/json")
+            response = requests.get("https://ipinfo.io/json", timeout=IP_INFO_TIMEOUT)
             response.raise_for_status()
             data = response.json()
             ip = data.get("ip")
             self.ip_address = ip
+            self._write_ip_info_cache(
+                {"ip": ip, "expires": time.time() + IP_INFO_TTL_SECONDS}
+            )
             return
         except Exception as e:
             logger.error(f"Failed to get IP and location: {e}")
-            self.ip_address = None
+            # An expired address is more useful than none
+            self.ip_address = cached.get("ip") if cached else None
             return
 
-    def _get_or_create_device_id(self):
-        """Get existing site ID or create a new one."""
+    def _read_ip_info_cache(self):
+        """Cached ipinfo.io result, or None if missing or unreadable."""
+        try:
+            with open(IP_INFO_FILE, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_ip_info_cache(self, ip_info):
+        """Persist the ipinfo.io result next to the device id."""
+        try:
+            os.makedirs(os.path.dirname(IP_INFO_FILE), exist_ok=True)
+            with open(IP_INFO_FILE, "w") as f:
+                json.dump(ip_info, f)
+        except OSError as e:
+            logger.warning(f"Failed to cache IP info: {e}")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _get_or_create_device_id():
+        """Get existing site ID or create a new one, reading the file once per process."""
         if os.path.exists(DEVICE_ID_FILE):
             with open(DEVICE_ID_FILE, "r") as f:
                 return f.read().strip()
@@ -82,14 +170,15 @@ class NetworkMonitor:
     def _query_prometheus(self, query):
         """Query Prometheus for metrics."""
         try:
-            prometheus_url = os.getenv("PROMETHEUS_URL", "http://prometheus:9090")
-            response = requests.get(
-                f"{prometheus_url}/api/v1/query", params={"query": query}
+            response = self._session.get(
+                self._prometheus_query_url,
+                params={"query": query},
+                timeout=PROMETHEUS_TIMEOUT,
             )
             response.raise_for_status()
             return response.json()
         except Exception as e:
-            logger.info(f"Failed to query Prometheus: {e} at {prometheus_url}")
+            logger.info(f"Failed to query Prometheus: {e} at {self._prometheus_query_url}")
             return None
 
     def _insert_ping_metrics(self, metrics_data):
@@ -120,23 +209,14 @@ class NetworkMonitor:
         # logger.info("Collecting ping metrics...")
         metrics_data = {}
 
-        for metric_name, query in PING_METRICS.items():
-            result = self._query_prometheus(query)
-            if result and "data" in result and "result" in result["data"]:
-                for r in result["data"]["result"]:
-                    value = float(r["value"][1])
-                    # Convert 'up' metrics to integer (0 or 1)
-                    if metric_name in [
-                        "google_up",
-                        "apple_up",
-                        "github_up",
-                        "pihole_up",
-                        "node_up",
-                        "speedtest_up",
-                    ]:
-                        metrics_data[metric_name] = int(value)
-                    else:
-                        metrics_data[metric_name] = value
+        result = self._query_prometheus(PING_QUERY)
+        if result and "data" in result and "result" in result["data"]:
+            for r in result["data"]["result"]:
+                metric_name = r["metric"].get(METRIC_LABEL)
+                if metric_name not in PING_METRICS:
+                    continue
+                convert = METRIC_CONVERTERS.get(metric_name, float)
+                metrics_data[metric_name] = convert(r["value"][1])
 
         if metrics_data:
             # logger.info(f"Found ping data {metrics_data}")
@@ -147,59 +227,54 @@ class NetworkMonitor:
         # logger.info("Checking for speedtest metrics...")
         metrics_data = {}
 
-        # First check if speedtest is up
-        speedtest_up_result = self._query_prometheus(SPEED_METRICS["download_mbps"])
-        if (
-            not speedtest_up_result
-            or "data" not in speedtest_up_result
-            or not speedtest_up_result["data"]["result"]
-        ):
+        result = self._query_prometheus(SPEED_QUERY)
+        if result and "data" in result and "result" in result["data"]:
+            for r in result["data"]["result"]:
+                metric_name = r["metric"].get(METRIC_LABEL)
+                # Keep the first series for each metric
+                if metric_name not in SPEED_METRICS or metric_name in metrics_data:
+                    continue
+                convert = METRIC_CONVERTERS.get(metric_name, float)
+                metrics_data[metric_name] = convert(r["value"][1])
+
+        # Only submit when the speedtest itself has reported
+        if "download_mbps" not in metrics_data:
             logger.info(f"No speedtest data found")
             return
 
         metrics_data["device_id"] = self.device_id
+        # logger.info(f"Found speedtest data {metrics_data}")
+        self._insert_speed_metrics(metrics_data)
 
-        for metric_name, query in SPEED_METRICS.items():
-            result = self._query_prometheus(query)
-            if (
-                result
-                and "data" in result
-                and "result" in result["data"]
-                and result["data"]["result"]
-            ):
-                r = result["data"]["result"][0]
-                value = float(r["value"][1])
-                # Convert bits to Mbps for speed metrics
-                if metric_name in ["download_mbps", "upload_mbps"]:
-                    metrics_data[metric_name] = value / 1_000_000
-                else:
-                    metrics_data[metric_name] = value
-        if metrics_data:
-            # logger.info(f"Found speedtest data {metrics_data}")
-            self._insert_speed_metrics(metrics_data)
+
+async def _run_periodically(interval_seconds, collect):
+    """Run collect now and then every interval_seconds.
+
+    Collection runs in a worker thread so its blocking HTTP calls don't hold
+    up the other task, and deadlines are absolute so the interval doesn't
+    drift by however long each run takes.
+    """
+    loop = asyncio.get_running_loop()
+    next_run = loop.time()
+    while True:
+        try:
+            await asyncio.to_thread(collect)
+        except Exception as e:
+            logger.error(f"Error running {collect.__name__}: {e}")
+        next_run += interval_seconds
+        await asyncio.sleep(max(next_run - loop.time(), 0))
 
 
 async def main():
     logger.info(f"Starting main.py in custom-metrics")
     monitor = NetworkMonitor()
 
-    # monitor.collect_ping_metrics()
-    # Schedule ping metrics collection every 5 minutes
-    schedule.every(5).minutes.do(monitor.collect_ping_metrics)
-
-    # Schedule speedtest metrics collection every 60 minutes
+    # Ping metrics every 5 minutes; speedtest metrics every 60 minutes
     # (it will only insert data if new speedtest results are available)
-    # schedule.every(60).minutes.do(monitor.collect_speed_metrics)
-    schedule.every(60).minutes.do(monitor.collect_speed_metrics)
-
-    # Run initial collection
-    monitor.collect_ping_metrics()
-    monitor.collect_speed_metrics()
-
-    # Keep the script running
-    while True:
-        await asyncio.sleep(1)
-        schedule.run_pending()
+    await asyncio.gather(
+        _run_periodically(PING_INTERVAL_SECONDS, monitor.collect_ping_metrics),
+        _run_periodically(SPEED_INTERVAL_SECONDS, monitor.collect_speed_metrics),
+    )
 
 
 if __name__ == "__main__":
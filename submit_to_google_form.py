@@ -1,10 +1,27 @@
 import requests
-import datetime
+import atexit
 import logging
+import queue
+import random
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+# Reused across submissions so the TLS connection to Google is kept alive
+_session = requests.Session()
+
+# Form posts are handed to a background thread so a 429 back-off never
+# stalls metric collection; the queue bounds memory if Google stays down
+SUBMIT_QUEUE_SIZE = 1000
+# Upper bound for a single 429 back-off
+MAX_RETRY_DELAY_SECONDS = 300
+# How long shutdown waits for queued submissions before giving up on them
+SHUTDOWN_FLUSH_SECONDS = 10
+_submit_queue = queue.Queue(maxsize=SUBMIT_QUEUE_SIZE)
+_submit_thread = None
+_submit_thread_lock = threading.Lock()
+
 PING_FORM_URL = "https://docs.google.com/forms/d/e/1FAIpQLSdKfiAaWkccMGS8tdpHZx6mTQglx4qyXI3FI4q9B1hbHpe-6w/formResponse"
 SPEED_FORM_URL = "https://docs.google.com/forms/d/e/1FAIpQLSe0KNSxoVx1eZKQzThy9du1f5b1QXI1RBkuZHjIRxY7e74vJA/formResponse"
 
@@ -46,41 +63,95 @@ def format_data(metrics_data, form_url, form_entry_ids):
     Submits collected metrics to the Google Form.
     """
     form_data = {}
-    form_data[form_entry_ids["local_timestamp"]] = datetime.datetime.now(
-        datetime.timezone.utc
-    ).strftime("%Y-%m-%d %H:%M:%S")
+    form_data[form_entry_ids["local_timestamp"]] = time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.gmtime()
+    )
 
     for metric_name, value in metrics_data.items():
         if metric_name in form_entry_ids:
             form_data[form_entry_ids[metric_name]] = str(value)
         # else:
         #     logger.warning(f"Metric '{metric_name}' not found in form_entry_ids. Skipping.")
-    _send_form_request(form_data, form_url)
+    _enqueue_form_request(form_data, form_url)
 
 
-def _send_form_request(form_data, form_url, retries=3, delay_seconds=60):
-    response = None  # Initialize response to None
+def _enqueue_form_request(form_data, form_url):
+    """
+    Queues a form submission for the background sender, starting it if needed.
+    """
+    global _submit_thread
+    with _submit_thread_lock:
+        if _submit_thread is None or not _submit_thread.is_alive():
+            _submit_thread = threading.Thread(target=_drain_submit_queue, daemon=True)
+            _submit_thread.start()
     try:
-        # logger.info(f"submiting data to Google Form. Response:")
-        response = requests.post(form_url, data=form_data)
-        response.raise_for_status()
-        # logger.info(f"Successfully submitted data to Google Form. Response: {response.status_code}")
-        return
-    except requests.exceptions.RequestException as e:
-        if e.response is not None and e.response.status_code == 429:
-            time.sleep(delay_seconds)
-            if retries <= 0:
+        _submit_queue.put_nowait((form_data, form_url))
+    except queue.Full:
+        logger.warning(f"Submission queue is full. Dropping data for {form_url}")
+
+
+def _drain_submit_queue():
+    while True:
+        item = _submit_queue.get()
+        try:
+            form_data, form_url = item
+            _send_form_request(form_data, form_url)
+        except Exception as e:
+            logger.error(f"Error submitting data to Google Form: {e}")
+        finally:
+            _submit_queue.task_done()
+
+
+def flush(timeout=None):
+    """
+    Blocks until every queued submission has been sent, or until timeout
+    seconds have passed. Returns True if the queue was fully drained.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _submit_queue.all_tasks_done:
+        while _submit_queue.unfinished_tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            _submit_queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def _shutdown():
+    # The sender is a daemon thread, so give it a bounded chance to empty the
+    # queue; a 429 back-off can outlast this and those submissions are lost
+    if not flush(timeout=SHUTDOWN_FLUSH_SECONDS):
+        logger.warning(
+            f"Exiting with {_submit_queue.unfinished_tasks} unsent Google Form submissions"
+        )
+    _session.close()
+
+
+atexit.register(_shutdown)
+
+
+def _send_form_request(form_data, form_url, retries=3, delay_seconds=60):
+    # 429 retries back off exponentially from delay_seconds, with jitter so
+    # several monitors throttled together don't retry in lockstep
+    for attempt in range(retries + 1):
+        try:
+            response = _session.post(form_url, data=form_data)
+            response.raise_for_status()
+            # logger.info(f"Successfully submitted data to Google Form. Response: {response.status_code}")
+            return
+        except requests.exceptions.RequestException as e:
+            if e.response is None or e.response.status_code != 429:
+                return
+            if attempt == retries:
                 # If it's the last attempt, report failure
                 logger.error(f"Failed to submit data to Google Form")
                 return
-            else:
-                #  continue to the next attempt ß
-                logger.warning(
-                    f"Received 429 (Too Many Requests). Retrying in {delay_seconds} seconds... (retrying {retries - 1} more times)"
-                )
-                return _send_form_request(
-                    form_data, form_url, retries - 1, delay_seconds
-                )
+            delay = min(MAX_RETRY_DELAY_SECONDS, delay_seconds * 2**attempt)
+            delay *= random.uniform(0.5, 1.5)
+            logger.warning(
+                f"Received 429 (Too Many Requests). Retrying in {delay:.0f} seconds... (retrying {retries - attempt - 1} more times)"
+            )
+            time.sleep(delay)
 
 
 def ping(metrics_data):
@@ -2,18 +2,19 @@ import unittest
 from unittest.mock import patch, MagicMock
 import os
 import sys
-import datetime
+import calendar
+import queue
 import requests
 import time # Import time for sleep mock
 
 # Adjust the path to import modules from the parent directory
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from submit_to_google_form import format_data, _send_form_request, ping, speed, PING_FORM_URL, SPEED_FORM_URL, PING_FORM_ENTRY_IDS, SPEED_FORM_ENTRY_IDS
+from submit_to_google_form import format_data, flush, _enqueue_form_request, _send_form_request, _shutdown, SHUTDOWN_FLUSH_SECONDS, ping, speed, PING_FORM_URL, SPEED_FORM_URL, PING_FORM_ENTRY_IDS, SPEED_FORM_ENTRY_IDS
 
 class TestGoogleForm(unittest.TestCase):
 
-    @patch('submit_to_google_form._send_form_request')
+    @patch('submit_to_google_form._enqueue_form_request')
     def test_format_data_ping(self, mock_send_form_request):
         metrics_data = {
             "device_id": "test_device_id",
@@ -22,12 +23,7 @@ class TestGoogleForm(unittest.TestCase):
             "http_latency": 0.05
         }
         
-        with patch('datetime.datetime') as mock_datetime:
-            mock_now = MagicMock()
-            mock_now.strftime.return_value = "2026-03-04 10:30:00"
-            mock_datetime.now.return_value = mock_now
-            mock_datetime.side_effect = lambda *args, **kw: datetime.datetime(*args, **kw) # Keep this for other potential datetime calls
-
+        with patch('time.strftime', return_value="2026-03-04 10:30:00"):
             format_data(metrics_data, PING_FORM_URL, PING_FORM_ENTRY_IDS)
 
             expected_form_data = {
@@ -39,7 +35,7 @@ class TestGoogleForm(unittest.TestCase):
             }
             mock_send_form_request.assert_called_once_with(expected_form_data, PING_FORM_URL)
 
-    @patch('submit_to_google_form._send_form_request')
+    @patch('submit_to_google_form._enqueue_form_request')
     def test_format_data_speed(self, mock_send_form_request):
         metrics_data = {
             "device_id": "test_device_id_speed",
@@ -48,12 +44,7 @@ class TestGoogleForm(unittest.TestCase):
             "ping_ms": 12.0,
         }
 
-        with patch('datetime.datetime') as mock_datetime:
-            mock_now = MagicMock()
-            mock_now.strftime.return_value = "2026-03-04 11:00:00"
-            mock_datetime.now.return_value = mock_now
-            mock_datetime.side_effect = lambda *args, **kw: datetime.datetime(*args, **kw)
-
+        with patch('time.strftime', return_value="2026-03-04 11:00:00"):
             format_data(metrics_data, SPEED_FORM_URL, SPEED_FORM_ENTRY_IDS)
 
             expected_form_data = {
@@ -65,7 +56,7 @@ class TestGoogleForm(unittest.TestCase):
             }
             mock_send_form_request.assert_called_once_with(expected_form_data, SPEED_FORM_URL)
 
-    @patch('requests.post')
+    @patch('submit_to_google_form._session.post')
     @patch('time.sleep', return_value=None) # Mock time.sleep to avoid actual delays
     def test_send_form_request_success(self, mock_sleep, mock_post):
         mock_response = MagicMock()
@@ -80,7 +71,7 @@ class TestGoogleForm(unittest.TestCase):
         mock_post.assert_called_once_with(form_url, data=form_data)
         mock_sleep.assert_not_called()
 
-    @patch('requests.post')
+    @patch('submit_to_google_form._session.post')
     @patch('time.sleep', return_value=None)
     def test_send_form_request_retry_429(self, mock_sleep, mock_post):
         mock_response_success = MagicMock()
@@ -106,7 +97,22 @@ class TestGoogleForm(unittest.TestCase):
         mock_post.assert_called_with(form_url, data=form_data)
         mock_sleep.assert_called_once_with(0) # Ensure sleep was called once with the specified delay
 
-    @patch('requests.post')
+    @patch('submit_to_google_form._session.post')
+    @patch('random.uniform', return_value=1.0) # No jitter so delays are predictable
+    @patch('time.sleep', return_value=None)
+    def test_send_form_request_backs_off_exponentially(self, mock_sleep, mock_uniform, mock_post):
+        mock_response_429 = MagicMock()
+        mock_response_429.status_code = 429
+        mock_response_429.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_response_429)
+        mock_post.return_value = mock_response_429
+
+        _send_form_request({"entry.123": "value"}, "http://test.com/form", retries=3, delay_seconds=60)
+
+        self.assertEqual(mock_post.call_count, 4)
+        # Doubles each time, with no sleep after the final attempt
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [60, 120, 240])
+
+    @patch('submit_to_google_form._session.post')
     @patch('time.sleep', return_value=None)
     def test_send_form_request_failure_non_429(self, mock_sleep, mock_post):
         # Simulate a non-429 error
@@ -123,6 +129,51 @@ class TestGoogleForm(unittest.TestCase):
         mock_post.assert_called_once_with(form_url, data=form_data)
         mock_sleep.assert_not_called() # No retry for non-429 errors
 
+    @patch('submit_to_google_form._enqueue_form_request')
+    def test_format_data_timestamp_is_utc(self, mock_send_form_request):
+        format_data({}, PING_FORM_URL, PING_FORM_ENTRY_IDS)
+
+        timestamp = mock_send_form_request.call_args[0][0][PING_FORM_ENTRY_IDS["local_timestamp"]]
+        parsed = calendar.timegm(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
+        self.assertLess(abs(parsed - time.time()), 5)
+
+    @patch('submit_to_google_form._send_form_request')
+    def test_enqueue_form_request_sends_in_background(self, mock_send_form_request):
+        form_data = {"entry.123": "value"}
+        form_url = "http://test.com/form"
+
+        _enqueue_form_request(form_data, form_url)
+        self.assertTrue(flush(timeout=5))
+
+        mock_send_form_request.assert_called_once_with(form_data, form_url)
+
+    @patch('submit_to_google_form._send_form_request')
+    def test_sender_survives_failed_submission(self, mock_send_form_request):
+        mock_send_form_request.side_effect = [Exception("boom"), None]
+        form_url = "http://test.com/form"
+
+        _enqueue_form_request({"entry.1": "a"}, form_url)
+        _enqueue_form_request({"entry.2": "b"}, form_url)
+
+        self.assertTrue(flush(timeout=5))
+        self.assertEqual(mock_send_form_request.call_count, 2)
+
+    @patch('submit_to_google_form._submit_thread') # Keep the real sender away from the mock queue
+    @patch('submit_to_google_form._submit_queue')
+    def test_enqueue_form_request_drops_when_full(self, mock_queue, mock_thread):
+        mock_thread.is_alive.return_value = True
+        mock_queue.put_nowait.side_effect = queue.Full
+
+        with self.assertLogs('submit_to_google_form', level='WARNING'):
+            _enqueue_form_request({"entry.123": "value"}, "http://test.com/form")
+
+    @patch('submit_to_google_form.flush', return_value=True)
+    @patch('submit_to_google_form._session')
+    def test_shutdown_closes_session(self, mock_session, mock_flush):
+        _shutdown()
+        mock_flush.assert_called_once_with(timeout=SHUTDOWN_FLUSH_SECONDS)
+        mock_session.close.assert_called_once()
+
     @patch('submit_to_google_form.format_data')
     def test_ping_function(self, mock_format_data):
         metrics_data = {"test_metric": 1}
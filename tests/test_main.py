@@ -2,6 +2,9 @@ import unittest
 from unittest.mock import patch, MagicMock, mock_open, AsyncMock
 import os
 import sys
+import json
+import shutil
+import time
 import uuid
 import requests
 import asyncio
@@ -9,7 +12,7 @@ import asyncio
 # Adjust the path to import modules from the parent directory
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from main import NetworkMonitor, PING_METRICS, SPEED_METRICS, main # Import main function
+from main import NetworkMonitor, IP_INFO_FILE, IP_INFO_TIMEOUT, PING_METRICS, SPEED_METRICS, PING_QUERY, SPEED_QUERY, METRIC_LABEL, PROMETHEUS_TIMEOUT, PING_INTERVAL_SECONDS, SPEED_INTERVAL_SECONDS, _combine_queries, _run_periodically, main # Import main function
 
 class TestNetworkMonitor(unittest.TestCase):
 
@@ -21,11 +24,11 @@ class TestNetworkMonitor(unittest.TestCase):
         os.environ["DEVICE_ID"] = "TestSiteID"
         os.environ["PROMETHEUS_URL"] = "http://mock-prometheus:9090"
 
-        # Clean up any existing device_id file before each test
-        if os.path.exists("network-monitor/device_id"):
-            os.remove("network-monitor/device_id")
-        if os.path.exists("network-monitor"):
-            os.rmdir("network-monitor")
+        # The device id is cached per process; start each test uncached
+        NetworkMonitor._get_or_create_device_id.cache_clear()
+
+        # Clean up any existing device_id and ip info files before each test
+        shutil.rmtree("network-monitor", ignore_errors=True)
 
     def tearDown(self):
         if self.original_device_id_env is not None:
@@ -40,11 +43,8 @@ class TestNetworkMonitor(unittest.TestCase):
             if "PROMETHEUS_URL" in os.environ:
                 del os.environ["PROMETHEUS_URL"]
 
-        # Clean up any created device_id file after each test
-        if os.path.exists("network-monitor/device_id"):
-            os.remove("network-monitor/device_id")
-        if os.path.exists("network-monitor"):
-            os.rmdir("network-monitor")
+        # Clean up any created device_id and ip info files after each test
+        shutil.rmtree("network-monitor", ignore_errors=True)
 
     @patch('os.path.exists')
     @patch('builtins.open', new_callable=mock_open, read_data="existing_device_id")
@@ -58,6 +58,11 @@ class TestNetworkMonitor(unittest.TestCase):
         mock_exists.assert_called_once_with("network-monitor/device_id")
         mock_file.assert_called_once_with("network-monitor/device_id", 'r')
 
+        # A second lookup is served from memory without touching the disk
+        self.assertEqual(monitor._get_or_create_device_id(), "existing_device_id")
+        mock_exists.assert_called_once()
+        mock_file.assert_called_once()
+
     @patch('os.path.exists')
     @patch('os.makedirs')
     @patch('builtins.open', new_callable=mock_open)
@@ -73,8 +78,34 @@ class TestNetworkMonitor(unittest.TestCase):
         mock_file.assert_called_once_with("network-monitor/device_id", 'w')
         mock_file().write.assert_called_once_with("12345678-1234-5678-1234-567812345678")
 
-    @patch.object(NetworkMonitor, "_get_ip_and_location")
     @patch("requests.get")
+    def test_get_ip_and_location_caches_result(self, mock_get):
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"ip": "203.0.113.7"}
+        mock_get.return_value = mock_response
+
+        monitor = NetworkMonitor()
+        self.assertEqual(monitor.ip_address, "203.0.113.7")
+        mock_get.assert_called_once_with("https://ipinfo.io/json", timeout=IP_INFO_TIMEOUT)
+
+        # A restart within the TTL reuses the cached address
+        monitor = NetworkMonitor()
+        self.assertEqual(monitor.ip_address, "203.0.113.7")
+        mock_get.assert_called_once()
+
+    @patch("requests.get", side_effect=requests.exceptions.RequestException("ipinfo down"))
+    def test_get_ip_and_location_falls_back_to_expired_cache(self, mock_get):
+        os.makedirs(os.path.dirname(IP_INFO_FILE), exist_ok=True)
+        with open(IP_INFO_FILE, "w") as f:
+            json.dump({"ip": "203.0.113.7", "expires": time.time() - 1}, f)
+
+        monitor = NetworkMonitor()
+
+        mock_get.assert_called_once()
+        self.assertEqual(monitor.ip_address, "203.0.113.7")
+
+    @patch.object(NetworkMonitor, "_get_ip_and_location")
+    @patch("requests.Session.get")
     def test_query_prometheus_success(self, mock_get, mock_ip):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -84,9 +115,9 @@ class TestNetworkMonitor(unittest.TestCase):
         monitor = NetworkMonitor()
         result = monitor._query_prometheus("test_query")
         self.assertEqual(result, {"data": {"result": [{"value": [0, "1"]}]}})
-        mock_get.assert_called_once_with("http://mock-prometheus:9090/api/v1/query", params={"query": "test_query"})
+        mock_get.assert_called_once_with("http://mock-prometheus:9090/api/v1/query", params={"query": "test_query"}, timeout=PROMETHEUS_TIMEOUT)
 
-    @patch('requests.get', side_effect=requests.exceptions.RequestException("Prometheus Error"))
+    @patch('requests.Session.get', side_effect=requests.exceptions.RequestException("Prometheus Error"))
     def test_query_prometheus_failure(self, mock_get):
         monitor = NetworkMonitor()
         result = monitor._query_prometheus("test_query")
@@ -125,27 +156,30 @@ class TestNetworkMonitor(unittest.TestCase):
     @patch.object(NetworkMonitor, '_query_prometheus')
     @patch.object(NetworkMonitor, '_insert_ping_metrics')
     def test_collect_ping_metrics(self, mock_insert_ping_metrics, mock_query_prometheus):
-        # Mock Prometheus responses for ping metrics (14 metrics in PING_METRICS)
-        mock_query_prometheus.side_effect = [
-            {"data": {"result": [{"value": [0, "1"]}]}},  # google_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # apple_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # github_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # windowsupdate_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # signon_okta_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # pihole_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # node_up
-            {"data": {"result": [{"value": [0, "1"]}]}},  # speedtest_up
-            {"data": {"result": [{"value": [0, "0.123"]}]}},  # http_latency
-            {"data": {"result": [{"value": [0, "10"]}]}},  # http_samples
-            {"data": {"result": [{"value": [0, "0.5"]}]}},  # http_time
-            {"data": {"result": [{"value": [0, "100"]}]}},  # http_content_length
-            {"data": {"result": [{"value": [0, "0.2"]}]}},  # http_duration
-            {"data": {"result": [{"value": [0, "3600"]}]}},  # uptime
-        ]
+        # One combined Prometheus response, each series tagged with its metric name
+        mock_query_prometheus.return_value = {"data": {"result": [
+            {"metric": {METRIC_LABEL: "google_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "apple_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "github_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "windowsupdate_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "netsuite_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "signon_okta_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "pihole_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "node_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "speedtest_up"}, "value": [0, "1"]},
+            {"metric": {METRIC_LABEL: "http_latency"}, "value": [0, "0.123"]},
+            {"metric": {METRIC_LABEL: "http_samples"}, "value": [0, "10"]},
+            {"metric": {METRIC_LABEL: "http_time"}, "value": [0, "0.5"]},
+            {"metric": {METRIC_LABEL: "http_content_length"}, "value": [0, "100"]},
+            {"metric": {METRIC_LABEL: "http_duration"}, "value": [0, "0.2"]},
+            {"metric": {METRIC_LABEL: "uptime"}, "value": [0, "3600"]},
+            {"metric": {"__name__": "unrelated"}, "value": [0, "42"]},
+        ]}}
         monitor = NetworkMonitor()
         monitor.device_id = "test_device_id"
         monitor.collect_ping_metrics()
 
+        mock_query_prometheus.assert_called_once_with(PING_QUERY)
         expected_metrics = {
             "google_up": 1,
             "http_latency": 0.123,
@@ -163,15 +197,15 @@ class TestNetworkMonitor(unittest.TestCase):
     @patch.object(NetworkMonitor, '_query_prometheus')
     @patch.object(NetworkMonitor, '_insert_speed_metrics')
     def test_collect_speed_metrics(self, mock_insert_speed_metrics, mock_query_prometheus):
-        # Mock Prometheus responses for speed metrics
-        mock_query_prometheus.side_effect = [
-            {"data": {"result": [{"value": [0, "100000000"]}]}}, # download_mbps (initial check)
-            {"data": {"result": [{"value": [0, "100000000"]}]}}, # download_mbps
-            {"data": {"result": [{"value": [0, "50000000"]}]}},  # upload_mbps
-            {"data": {"result": [{"value": [0, "25.5"]}]}},      # ping_ms
-            {"data": {"result": [{"value": [0, "5.1"]}]}},       # jitter_ms
-            {"data": {"result": [{"value": [0, "86400.0"]}]}},   # uptime (seconds)
-        ]
+        # One combined Prometheus response; only the first series per metric is used
+        mock_query_prometheus.return_value = {"data": {"result": [
+            {"metric": {METRIC_LABEL: "download_mbps"}, "value": [0, "100000000"]},
+            {"metric": {METRIC_LABEL: "upload_mbps"}, "value": [0, "50000000"]},
+            {"metric": {METRIC_LABEL: "ping_ms"}, "value": [0, "25.5"]},
+            {"metric": {METRIC_LABEL: "jitter_ms"}, "value": [0, "5.1"]},
+            {"metric": {METRIC_LABEL: "uptime"}, "value": [0, "86400.0"]},
+            {"metric": {METRIC_LABEL: "ping_ms"}, "value": [0, "99.9"]},
+        ]}}
 
         monitor = NetworkMonitor()
         monitor.device_id = "test_device_id"
@@ -185,8 +219,28 @@ class TestNetworkMonitor(unittest.TestCase):
             "jitter_ms": 5.1,
             "uptime": 86400.0,
         }
+        mock_query_prometheus.assert_called_once_with(SPEED_QUERY)
         mock_insert_speed_metrics.assert_called_once_with(expected_metrics)
 
+    @patch.object(NetworkMonitor, '_query_prometheus')
+    @patch.object(NetworkMonitor, '_insert_speed_metrics')
+    def test_collect_speed_metrics_without_download(self, mock_insert_speed_metrics, mock_query_prometheus):
+        # Other series alone don't count as a speedtest result
+        mock_query_prometheus.return_value = {"data": {"result": [
+            {"metric": {METRIC_LABEL: "uptime"}, "value": [0, "86400.0"]},
+        ]}}
+        monitor = NetworkMonitor()
+        monitor.collect_speed_metrics()
+        mock_insert_speed_metrics.assert_not_called()
+
+    def test_combine_queries(self):
+        query = _combine_queries({"a_up": 'up{job="a"}', "b_time": "time()"})
+        self.assertEqual(
+            query,
+            f'label_replace(up{{job="a"}}, "{METRIC_LABEL}", "a_up", "", "")'
+            f' or label_replace(time(), "{METRIC_LABEL}", "b_time", "", "")',
+        )
+
     @patch.object(NetworkMonitor, '_query_prometheus', return_value=None)
     @patch.object(NetworkMonitor, '_insert_speed_metrics')
     def test_collect_speed_metrics_no_data(self, mock_insert_speed_metrics, mock_query_prometheus):
@@ -194,35 +248,34 @@ class TestNetworkMonitor(unittest.TestCase):
         monitor.collect_speed_metrics()
         mock_insert_speed_metrics.assert_not_called()
 
+    @patch('main._run_periodically', new_callable=AsyncMock)
     @patch('main.NetworkMonitor')
-    @patch('schedule.every')
-    @patch('asyncio.sleep', new_callable=AsyncMock) # Use AsyncMock for awaitable
-    @patch('schedule.run_pending')
-    def test_main_function(self, mock_run_pending, mock_async_sleep, mock_schedule_every, mock_network_monitor_class):
-        # Mock the NetworkMonitor instance and its methods
+    def test_main_function(self, mock_network_monitor_class, mock_run_periodically):
         mock_monitor_instance = MagicMock()
         mock_network_monitor_class.return_value = mock_monitor_instance
 
-        # Mock asyncio.sleep: return immediately, then raise to exit loop
-        mock_async_sleep.side_effect = [None, None, asyncio.CancelledError()]
-
-        # Call the main function
-        with self.assertRaises(asyncio.CancelledError):
-            asyncio.run(main())
+        asyncio.run(main())
 
-        # Assertions
         mock_network_monitor_class.assert_called_once()
-        mock_monitor_instance.collect_ping_metrics.assert_called() # Called twice: once initially, once by schedule
-        mock_monitor_instance.collect_speed_metrics.assert_called() # Called twice: once initially, once by schedule
+        mock_run_periodically.assert_any_call(PING_INTERVAL_SECONDS, mock_monitor_instance.collect_ping_metrics)
+        mock_run_periodically.assert_any_call(SPEED_INTERVAL_SECONDS, mock_monitor_instance.collect_speed_metrics)
 
-        # Check scheduling calls
-        mock_schedule_every.assert_any_call(5)
-        mock_schedule_every().minutes.do.assert_any_call(mock_monitor_instance.collect_ping_metrics)
-        mock_schedule_every.assert_any_call(60)
-        mock_schedule_every().minutes.do.assert_any_call(mock_monitor_instance.collect_speed_metrics)
+    @patch('asyncio.sleep', new_callable=AsyncMock) # Use AsyncMock for awaitable
+    def test_run_periodically(self, mock_async_sleep):
+        collect = MagicMock(__name__="collect", side_effect=[Exception("Prometheus Error"), None])
+
+        # Return immediately, then raise to exit the loop
+        mock_async_sleep.side_effect = [None, asyncio.CancelledError()]
 
-        # Ensure run_pending was called
-        self.assertTrue(mock_run_pending.called)
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(_run_periodically(300, collect))
+
+        # Runs straight away, and keeps going after a failed run
+        self.assertEqual(collect.call_count, 2)
+        # Sleeps until the next deadline rather than polling
+        first_sleep = mock_async_sleep.call_args_list[0].args[0]
+        self.assertLessEqual(first_sleep, 300)
+        self.assertGreater(first_sleep, 290)
 
 
 if __name__ == '__main__':